@@ -1,8 +1,10 @@
 import streamlit as st
 import mysql.connector
+import mysql.connector.pooling
 import pandas as pd
 from datetime import datetime
 import io
+import math
 import xlsxwriter
 
 # =======================================================
@@ -17,11 +19,56 @@ except FileNotFoundError:
 # =======================================================
 # FUNCIONES DE BASE DE DATOS
 # =======================================================
+def db_config():
+    config = dict(DB_CONFIG)
+    # autocommit: los INSERT sueltos no necesitan un COMMIT aparte; el guardado masivo abre su transacción.
+    # Se fuerza (no setdefault): init_db y "Crear Obra" no hacen commit y se perderían con autocommit=false
+    config["autocommit"] = True
+    # Extensión C del conector: decodifica el protocolo fuera del intérprete
+    config.setdefault("use_pure", False)
+    return config
+
+@st.cache_resource
+def get_pool():
+    # Pool creado una sola vez por proceso del servidor: las sesiones reciben conexiones ya abiertas
+    return mysql.connector.pooling.MySQLConnectionPool(
+        pool_name="inv",
+        pool_size=8,
+        pool_reset_session=True,
+        **db_config()
+    )
+
 def get_connection():
-    return mysql.connector.connect(**DB_CONFIG)
+    # conn.close() devuelve la conexión al pool en lugar de cerrarla
+    # (el pool ya verifica y reconecta la conexión al entregarla)
+    try:
+        return get_pool().get_connection()
+    except mysql.connector.errors.PoolError:
+        # Pool agotado: no espera, así que se abre una conexión directa como antes del pool
+        return mysql.connector.connect(**db_config())
+
+def query_df(sql, params=None, conn=None):
+    # Cursor directo + DataFrame: evita el adaptador genérico DB-API de pd.read_sql
+    propia = conn is None
+    if propia:
+        conn = get_connection()
+    try:
+        cur = conn.cursor(buffered=True)
+        try:
+            cur.execute(sql, params or ())
+            cols = [d[0] for d in cur.description]
+            return pd.DataFrame(cur.fetchall(), columns=cols)
+        finally:
+            cur.close()
+    finally:
+        if propia:
+            conn.close()
 
+# Las migraciones se ejecutan una sola vez por arranque del servidor, no en cada rerun
+@st.cache_resource
 def init_db():
-    conn = get_connection()
+    # Conexión propia (fuera del pool) para que las migraciones no ocupen un slot
+    conn = mysql.connector.connect(**db_config())
     cursor = conn.cursor()
     
     # Tabla Sitios (Obras)
@@ -63,19 +110,148 @@ def init_db():
         ("empresa", "VARCHAR(100) DEFAULT 'Sin Asignar'") 
     ]
     
+    # Se consultan las columnas existentes una vez y solo se altera lo que falta
+    cursor.execute("""
+        SELECT COLUMN_NAME FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'equipos'
+    """)
+    existentes = {r[0].lower() for r in cursor.fetchall()}
     for col, tipo in nuevas_columnas:
-        try:
+        if col not in existentes:
             cursor.execute(f"ALTER TABLE equipos ADD COLUMN {col} {tipo}")
-        except: pass 
+
+    # --- ÍNDICES ---
+    # En ASC: InnoDB agrega el id (ASC) al final, así que recorrido hacia atrás da
+    # exactamente "ORDER BY ultima_conexion DESC, id DESC" sin filesort
+    nuevos_indices = [
+        ("idx_equipos_sitio", "sitio_id", "sitio_id"),
+        ("idx_equipos_ultconn", "ultima_conexion", "ultima_conexion"),
+        # Sirve el filtro por empresa ya ordenado (sin filesort)
+        ("idx_empresa_ultconex", "empresa", "empresa, ultima_conexion"),
+    ]
+
+    # Solo se crean si la columna no encabeza ya algún índice (la FK de sitio_id suele traer uno)
+    cursor.execute("""
+        SELECT INDEX_NAME, COLUMN_NAME FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'equipos' AND SEQ_IN_INDEX = 1
+    """)
+    indices = cursor.fetchall()
+    nombres_idx = {r[0] for r in indices}
+    cols_idx = {r[1].lower() for r in indices}
+    for nombre, col, definicion in nuevos_indices:
+        if nombre not in nombres_idx and col not in cols_idx:
+            cursor.execute(f"CREATE INDEX {nombre} ON equipos ({definicion})")
 
     # Asegurar estados por defecto
     estados = ["LIBRE", "DEFECTUOSA", "OFICINA CENTRAL"]
-    for estado in estados:
-        try: cursor.execute("INSERT IGNORE INTO sitios (nombre) VALUES (%s)", (estado,))
-        except: pass
+    cursor.execute(
+        f"SELECT nombre FROM sitios WHERE nombre IN ({','.join(['%s'] * len(estados))})",
+        tuple(estados)
+    )
+    presentes = {r[0] for r in cursor.fetchall()}
+    faltantes = [(e,) for e in estados if e not in presentes]
+    if faltantes:
+        # executemany junta los INSERT en un solo VALUES (...),(...),(...) -> un round-trip
+        cursor.executemany("INSERT IGNORE INTO sitios (nombre) VALUES (%s)", faltantes)
 
-    conn.commit()
     conn.close()
+    return True
+
+# --- LECTURAS CACHEADAS (se invalidan con .clear() al guardar) ---
+@st.cache_data(ttl=60)
+def load_sitios():
+    return query_df("SELECT id, nombre FROM sitios ORDER BY nombre")
+
+@st.cache_resource(ttl=120)
+def obras_maps():
+    # Opciones del selector de Obra + mapa id -> nombre (sin JOIN contra sitios).
+    # cache_resource: se comparte el mismo objeto (solo lectura) sin deserializarlo en cada rerun.
+    # El mapa es una Series indexada por id: .map() la usa directo como indexador vectorizado
+    df = load_sitios()
+    return df['nombre'].tolist(), pd.Series(df['nombre'].values, index=df['id'])
+
+@st.cache_data(ttl=60)
+def load_conteos():
+    # Un solo GROUP BY sirve para la métrica de cualquier filtro
+    df = query_df("SELECT empresa, COUNT(*) AS c FROM equipos GROUP BY empresa")
+    return dict(zip(df['empresa'], df['c']))
+
+# Columnas de hardware que el editor no muestra: se leen solo al exportar
+COLS_HARDWARE = ['mainboard', 'video', 'antivirus', 'windows_ver']
+
+# Filas por página del editor: lo que viaja al navegador escala con la página, no con la tabla
+TAM_PAGINA = 100
+
+def sql_equipos(filtro: str, pagina=None, columnas_extra=()):
+    # pagina=None trae todo el filtro (para exportar); columnas_extra se agregan al SELECT
+    extra = "".join(f", {c}" for c in columnas_extra)
+    query = f"""
+        SELECT 
+            id, codigo_inventario, codigo_manual, marca_modelo, usuario, tipo, 
+            detalles, sitio_id, ultima_conexion, ram, procesador, disco, 
+            serie, empresa{extra}
+        FROM equipos 
+    """
+    
+    params = ()
+    if filtro != "TODAS":
+        query += " WHERE empresa = %s"
+        params = (filtro,)
+    
+    # id como desempate para que las páginas no se solapen con fechas repetidas
+    query += " ORDER BY ultima_conexion DESC, id DESC"
+    if pagina is not None:
+        query += f" LIMIT {int(TAM_PAGINA)} OFFSET {(int(pagina) - 1) * TAM_PAGINA}"
+
+    return query, params
+
+@st.cache_data(ttl=60)
+def load_equipos(filtro: str, pagina: int = 1):
+    df = query_df(*sql_equipos(filtro, pagina))
+    # datetime64 incluso si la página trae solo NULLs (si no, queda como object)
+    df['ultima_conexion'] = pd.to_datetime(df['ultima_conexion'])
+    return df
+
+# =======================================================
+# EXPORTACIÓN
+# =======================================================
+# Filas que se traen del cursor por vez al exportar
+LOTE_EXPORT = 500
+
+def build_xlsx(filtro, mapa_obras):
+    # Todo el inventario del filtro, leído del cursor por lotes y escrito fila a fila sin DataFrame.
+    # constant_memory: xlsxwriter vuelca cada fila al terminarla, así nada en Python crece con la tabla
+    # (solo el .xlsx comprimido que se devuelve).
+    query, params = sql_equipos(filtro, columnas_extra=COLS_HARDWARE)
+    output = io.BytesIO()
+    wb = xlsxwriter.Workbook(output, {'constant_memory': True, 'default_date_format': 'yyyy-mm-dd hh:mm'})
+    ws = wb.add_worksheet("Inventario")
+    conn = get_connection()
+    try:
+        # Cursor sin buffer: las filas llegan del servidor a medida que se piden
+        cur = conn.cursor()
+        try:
+            cur.execute(query, params)
+            cols = [d[0] for d in cur.description]
+            i_sitio = cols.index('sitio_id')
+            ws.write_row(0, 0, [c for c in cols if c != 'sitio_id'] + ['Obra'])
+            r = 1
+            while True:
+                lote = cur.fetchmany(LOTE_EXPORT)
+                if not lote:
+                    break
+                for fila in lote:
+                    fila = list(fila)
+                    sitio = fila.pop(i_sitio)
+                    fila.append(mapa_obras.get(sitio, "Sin Asignar"))
+                    ws.write_row(r, 0, fila)
+                    r += 1
+        finally:
+            cur.close()
+    finally:
+        conn.close()
+    wb.close()
+    return output.getvalue()
 
 # =======================================================
 # INTERFAZ WEB
@@ -107,14 +283,13 @@ with st.sidebar:
     st.divider()
     
     # Métricas rápidas
-    conn = get_connection()
+    conteos = load_conteos()
     if filtro_empresa == "TODAS":
-        total = pd.read_sql("SELECT COUNT(*) as c FROM equipos", conn).iloc[0]['c']
+        total = sum(conteos.values())
         st.metric("Total Equipos (Global)", total)
     else:
-        total = pd.read_sql(f"SELECT COUNT(*) as c FROM equipos WHERE empresa = '{filtro_empresa}'", conn).iloc[0]['c']
+        total = conteos.get(filtro_empresa, 0)
         st.metric(f"Total en {filtro_empresa[:15]}...", total)
-    conn.close()
 
 st.title("🖥️ Gestión Centralizada de Activos TI")
 
@@ -122,36 +297,31 @@ tab1, tab2 = st.tabs(["📋 Inventario & Asignación", "🏗️ Gestión de Obra
 
 # --- PESTAÑA 1: TABLA PRINCIPAL ---
 with tab1:
-    conn = get_connection()
-    
     # Cargar Obras
-    df_sitios = pd.read_sql("SELECT id, nombre FROM sitios ORDER BY nombre", conn)
-    lista_obras = df_sitios['nombre'].tolist()
-    mapa_obras = dict(zip(df_sitios['nombre'], df_sitios['id'])) 
-    mapa_ids = dict(zip(df_sitios['id'], df_sitios['nombre']))
-
-    # CONSTRUIR QUERY SEGÚN EL FILTRO
-    base_query = """
-        SELECT 
-            id, codigo_inventario, codigo_manual, marca_modelo, usuario, tipo, 
-            detalles, sitio_id, ultima_conexion, ram, procesador, disco, 
-            serie, mainboard, video, antivirus, windows_ver, empresa
-        FROM equipos 
-    """
-    
-    if filtro_empresa != "TODAS":
-        base_query += f" WHERE empresa = '{filtro_empresa}'"
-    
-    base_query += " ORDER BY ultima_conexion DESC"
+    lista_obras, mapa_ids = obras_maps()
 
-    df_equipos = pd.read_sql(base_query, conn)
-    conn.close()
+    # Cargar equipos según el filtro (una página a la vez)
+    total_paginas = max(1, math.ceil(total / TAM_PAGINA))
+    # Label y key estables (sin max_value): si cambia el total (TTL, guardado, agente) el widget
+    # no se recrea, así no salta a la página 1 ni se pierden ediciones sin guardar.
+    # Solo vuelve a la página 1 cuando cambia el filtro de empresa.
+    if st.session_state.get('pagina_filtro') != filtro_empresa:
+        st.session_state['pagina_filtro'] = filtro_empresa
+        st.session_state['pagina_equipos'] = 1
+    elif st.session_state.get('pagina_equipos', 1) > total_paginas:
+        st.session_state['pagina_equipos'] = total_paginas
+    pagina = st.number_input("Página", min_value=1, step=1, key="pagina_equipos")
+    pagina = min(int(pagina), total_paginas)
+    st.caption(f"Página {pagina} de {total_paginas}")
+    df_equipos = load_equipos(filtro_empresa, pagina)
 
     # Mapear Obra
     df_equipos['Obra'] = df_equipos['sitio_id'].map(mapa_ids).fillna("Sin Asignar")
+    # sitio_id ya quedó resuelto en 'Obra': no hace falta serializarlo al navegador
+    df_equipos = df_equipos.drop(columns=['sitio_id'])
     
     # Columnas que NO se editan (vienen del agente)
-    cols_bloqueadas = ('codigo_inventario', 'serie', 'ram', 'procesador', 'disco', 'mainboard', 'video', 'ultima_conexion', 'antivirus', 'windows_ver')
+    cols_bloqueadas = ('codigo_inventario', 'serie', 'ram', 'procesador', 'disco', 'ultima_conexion')
 
     # --- TABLA EDITABLE ---
     st.info("💡 Tip: Usa la columna **'Empresa Asignada'** para clasificar los equipos nuevos que llegan como 'Sin Asignar'.")
@@ -159,7 +329,7 @@ with tab1:
     cambios = st.data_editor(
         df_equipos,
         column_config={
-            "id": None, "sitio_id": None, 
+            "id": None, 
             
             # NUEVA COLUMNA SELECTORA DE EMPRESA
             "empresa": st.column_config.SelectboxColumn(
@@ -177,10 +347,6 @@ with tab1:
             "codigo_inventario": st.column_config.TextColumn("Hostname", disabled=True),
             "ultima_conexion": st.column_config.DatetimeColumn("Última Conexión", format="D MMM YYYY, h:mm a", disabled=True),
             "tipo": st.column_config.SelectboxColumn("Tipo", options=["Laptop", "PC Escritorio", "Servidor"], width="small"),
-            "mainboard": st.column_config.TextColumn("Placa", disabled=True),
-            "video": st.column_config.TextColumn("Video", disabled=True),
-            "antivirus": st.column_config.TextColumn("AV", disabled=True),
-            "windows_ver": st.column_config.TextColumn("OS", disabled=True),
         },
         disabled=cols_bloqueadas, 
         num_rows="dynamic",       
@@ -194,52 +360,70 @@ with tab1:
     # --- BOTÓN GUARDAR ---
     if st.button("💾 Guardar Cambios y Asignaciones", type="primary"):
         conn = get_connection()
-        cursor = conn.cursor()
+        # Cursor preparado: el UPDATE se prepara una vez y el lote solo envía parámetros
+        cursor = conn.cursor(prepared=True)
         try:
+            # Borrados + actualizaciones van en una sola transacción explícita
+            conn.start_transaction()
             # 1. DETECTAR BORRADOS (Solo si no estamos en vista filtrada parcial que oculte IDs)
             # Para seguridad, el borrado mejor hacerlo con cuidado. Aquí mantenemos la lógica simple:
             if filtro_empresa == "TODAS":
-                cursor.execute("SELECT id FROM equipos")
-                ids_db = set(row[0] for row in cursor.fetchall())
-                ids_screen = set(cambios['id'].dropna().astype(int).tolist())
-                ids_del = ids_db - ids_screen
+                # deleted_rows trae las posiciones (en df_equipos) de las filas que el usuario borró
+                deleted_rows = st.session_state["editor_global"]["deleted_rows"]
+                ids_del = [int(df_equipos.iloc[i]['id']) for i in deleted_rows]
                 if ids_del:
                     format_str = ','.join(['%s'] * len(ids_del))
                     cursor.execute(f"DELETE FROM equipos WHERE id IN ({format_str})", tuple(ids_del))
 
             # 2. ACTUALIZACIONES (Empresa, Obra, Notas, etc.)
-            for index, row in cambios.iterrows():
-                nombre_obra = row['Obra']
-                id_obra_real = mapa_obras.get(nombre_obra)
-                
-                if row['codigo_inventario']:
-                    sql = """
-                        UPDATE equipos SET 
-                        sitio_id = %s, tipo = %s,
-                        codigo_manual = %s, detalles = %s, 
-                        empresa = %s  -- <--- AQUÍ SE GUARDA LA EMPRESA QUE SELECCIONASTE
-                        WHERE codigo_inventario = %s
-                    """
-                    vals = (
-                        id_obra_real, row['tipo'], row['codigo_manual'], 
-                        row['detalles'], row['empresa'], row['codigo_inventario']
-                    )
-                    cursor.execute(sql, vals)
+            # Solo se envían las filas que el editor marcó como editadas (edited_rows: {fila: {col: valor}})
+            cols_editables = {'Obra', 'tipo', 'codigo_manual', 'detalles', 'empresa'}
+            edited_rows = st.session_state["editor_global"]["edited_rows"]
+            filas_editadas = [int(i) for i, campos in edited_rows.items() if cols_editables & set(campos)]
+            modificados = cambios[cambios.index.isin(filas_editadas) & cambios['id'].notna()]
+
+            # itertuples entrega tuplas planas en el orden de los %s (sin el costo de iterrows)
+            registros = modificados[['Obra', 'tipo', 'codigo_manual', 'detalles', 'empresa', 'codigo_inventario']]
+            vals_list = [
+                vals for vals in registros.itertuples(index=False, name=None)
+                if vals[-1]
+            ]
+
+            if vals_list:
+                # La Obra se resuelve a sitio_id en el servidor (LEFT JOIN: sin coincidencia queda NULL)
+                sql = """
+                    UPDATE equipos e
+                    LEFT JOIN sitios s ON s.nombre = %s
+                    SET 
+                    e.sitio_id = s.id, e.tipo = %s,
+                    e.codigo_manual = %s, e.detalles = %s, 
+                    e.empresa = %s  -- <--- AQUÍ SE GUARDA LA EMPRESA QUE SELECCIONASTE
+                    WHERE e.codigo_inventario = %s
+                """
+                # executemany solo fusiona INSERTs: cada UPDATE sigue siendo un round-trip,
+                # el ahorro está en enviar únicamente las filas editadas
+                cursor.executemany(sql, vals_list)
             
             conn.commit()
             st.toast("✅ Asignaciones de empresa guardadas.", icon="🏢")
+            load_equipos.clear()
+            load_conteos.clear()
             st.rerun()
         except Exception as e:
+            conn.rollback()
             st.error(f"Error: {e}")
         finally:
             conn.close()
 
     # EXCEL
-    if not cambios.empty:
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-            cambios.to_excel(writer, index=False, sheet_name="Inventario")
-        st.download_button(label="📗 Descargar Excel", data=output.getvalue(), file_name="inventario_ti.xlsx", mime="application/vnd.ms-excel")
+    # El archivo se arma solo al pedirlo, no en cada rerun.
+    # Exporta todo el inventario del filtro (no solo la página en pantalla), con el hardware
+    if total:
+        if st.button("📗 Generar Excel"):
+            xlsx = build_xlsx(filtro_empresa, mapa_ids.to_dict())
+            # La descarga se ofrece solo en el rerun que generó el archivo: nunca queda
+            # un archivo viejo para otra vista (otro filtro, página o datos ya editados)
+            st.download_button(label="📥 Descargar Excel", data=xlsx, file_name="inventario_ti.xlsx", mime="application/vnd.ms-excel")
 
 # --- PESTAÑA 2: OBRAS ---
 with tab2:
@@ -250,16 +434,15 @@ with tab2:
         if st.button("Crear Obra"):
             if nueva_obra:
                 conn = get_connection()
+                cursor = conn.cursor()
                 try:
-                    cursor = conn.cursor()
                     cursor.execute("INSERT INTO sitios (nombre) VALUES (%s)", (nueva_obra,))
-                    conn.commit()
                     st.success(f"Obra '{nueva_obra}' creada.")
+                    load_sitios.clear()
+                    obras_maps.clear()
                     st.rerun()
                 except: st.error("Ya existe.")
                 finally: conn.close()
     with col2:
-        conn = get_connection()
-        df_obras = pd.read_sql("SELECT nombre FROM sitios ORDER BY nombre", conn)
-        conn.close()
+        df_obras = load_sitios()[['nombre']]
         st.dataframe(df_obras, hide_index=True, use_container_width=True)